@@ -1,11 +1,25 @@
 # main.py
 
 import functions_framework
+from flask import Response
 import google.generativeai as genai
 import os
 import json
+import base64
+import orjson
+import msgspec
+import functools
+import hashlib
+import math
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from google.cloud import firestore
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import Annotated, Optional
+from typing_extensions import TypedDict
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 from google.cloud.firestore_v1._helpers import DatetimeWithNanoseconds
 
@@ -17,147 +31,537 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable is not set")
 
-genai.configure(api_key=GEMINI_API_KEY)
+# gRPC keeps one HTTP/2 channel open across calls instead of per-call REST
+# requests; Firestore already uses gRPC by default.
+genai.configure(api_key=GEMINI_API_KEY, transport='grpc')
 
 print("[Gemini Config] Using API key authentication")
 print(f"[Gemini Config] GEMINI_API_KEY set: {bool(GEMINI_API_KEY)}")
 
-try:
-    models_list = list(genai.list_models())
-    print(f"[Gemini Config] API key valid. {len(models_list)} models available.")
-except Exception as e:
-    print(f"[Gemini Config] ERROR: API key check failed — {e}")
+# Listing models costs a network round-trip on every cold start; the first
+# generate_content call surfaces auth errors anyway, so only check on request.
+if os.environ.get("GEMINI_HEALTHCHECK"):
+    try:
+        models_list = list(genai.list_models())
+        print(f"[Gemini Config] API key valid. {len(models_list)} models available.")
+    except Exception as e:
+        print(f"[Gemini Config] ERROR: API key check failed — {e}")
+
+_db = None
+_db_lock = threading.Lock()
 
-db = firestore.Client()
+def get_db() -> firestore.Client:
+    # Callers that arrive during the prewarm wait for it instead of building
+    # a second client. The library already sets a 30s gRPC keepalive.
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = firestore.Client()
+    return _db
 
-ALLOWED_ORIGINS = [
+def _prewarm_db():
+    try:
+        # Client() creates its gRPC transport lazily; touching the API
+        # attribute builds the transport and channel now
+        get_db()._firestore_api
+    except Exception as e:
+        print(f"[Firestore] Prewarm failed — {e}")
+
+# Build the client off the import path so the first request finds it ready
+threading.Thread(target=_prewarm_db, daemon=True).start()
+
+ALLOWED_ORIGINS = frozenset({
     'http://localhost:5173',
     'http://localhost:5174',
     'http://localhost:5175'
-]
+})
+ALLOW_ANY_ORIGIN = '*' in ALLOWED_ORIGINS
+
+BASE_HEADERS = MappingProxyType({
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Requested-With, Authorization',
+    'Access-Control-Max-Age': '3600'
+})
+
+# Work the request waits on (embedding while Firestore is read) gets its own
+# pool so it never queues behind bookkeeping writes on the background pool.
+_request_executor = ThreadPoolExecutor(max_workers=8)
+_executor = ThreadPoolExecutor(max_workers=8)
+
+# Full Pub/Sub topic path (projects/<project>/topics/<topic>) for durable
+# memory updates; unset to write them from a background thread instead.
+PREFS_UPDATE_TOPIC = os.environ.get("PREFS_UPDATE_TOPIC")
+PREFS_PUBLISH_TIMEOUT = 5  # seconds
+
+PREFS_CACHE_SIZE = 1024
+PREFS_CACHE_TTL = 60  # seconds
+
+# story_prefs fields the story prompt uses; last_plan grows over time and is
+# only written, so it is never fetched.
+PREFS_FIELDS = ['preferred_tone', 'feedback_counts', 'last_keywords']
+
+# Streaming requests with at most this many keywords (and no stored prefs)
+# skip the planner call
+SIMPLE_KEYWORD_LIMIT = 3
+
+STORY_CACHE_COLLECTION = 'story_cache'
+EMBEDDING_MODEL = 'models/text-embedding-004'
+SIMILARITY_THRESHOLD = 0.92
+EMBEDDING_INDEX_SIZE = 256
+# story_cache documents carry expire_at for a Firestore TTL policy on that field
+STORY_CACHE_TTL = timedelta(days=7)
+
+def _json_default(o):
+    # orjson only serializes exact datetime instances natively; Firestore
+    # returns DatetimeWithNanoseconds, a subclass, which lands here.
+    if isinstance(o, (DatetimeWithNanoseconds, datetime)):
+        return o.isoformat()
+    return str(o)  # fallback for other non-serializable types
 
 def safe_json_dumps(data):
-    def default(o):
-        if isinstance(o, DatetimeWithNanoseconds):
-            return o.isoformat()
-        if isinstance(o, datetime):
-            return o.isoformat()
-        return str(o)  # fallback for other non-serializable types
-    return json.dumps(data, default=default)
+    return orjson.dumps(data, default=_json_default, option=orjson.OPT_NAIVE_UTC).decode()
+
+def log_background_failure(name: str):
+    """Return a done-callback that logs the future's exception, if any."""
+    def log_failure(future):
+        if future.exception() is not None:
+            print(f"[Background] {name} failed — {future.exception()}")
+    return log_failure
+
+def run_in_background(fn, *args):
+    _executor.submit(fn, *args).add_done_callback(log_background_failure(fn.__name__))
 
 # --- Firestore helpers ---
-def get_user_preferences(user_id: str, app_id: str) -> dict:
-    doc = db.collection(
-        f'artifacts/{app_id}/users/{user_id}/preferences'
-    ).document('story_prefs').get()
-    return doc.to_dict() if doc.exists else {}
+# Per-instance cache of story_prefs keyed by (app_id, user_id), so bursts of
+# requests from the same user skip the Firestore read.
+_prefs_cache = TTLCache(maxsize=PREFS_CACHE_SIZE, ttl=PREFS_CACHE_TTL)
+_prefs_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=4096)
+def prefs_ref(app_id: str, user_id: str) -> firestore.DocumentReference:
+    # References are immutable handles, so build each user's path only once
+    return get_db().collection('artifacts').document(app_id).collection(
+        'users'
+    ).document(user_id).collection('preferences').document('story_prefs')
+
+def _write_user_preferences(user_id: str, app_id: str, data: dict):
+    prefs_ref(app_id, user_id).set({**data, 'last_updated': firestore.SERVER_TIMESTAMP}, merge=True)
+
+def get_user_preferences(user_id: str, app_id: str) -> tuple:
+    """Return the user's story_prefs and their JSON encoding for prompts."""
+    key = (app_id, user_id)
+    with _prefs_cache_lock:
+        entry = _prefs_cache.get(key)
+    if entry is None:
+        doc = prefs_ref(app_id, user_id).get(field_paths=PREFS_FIELDS)
+        prefs = doc.to_dict() if doc.exists else {}
+        entry = (prefs, safe_json_dumps(prefs))
+        with _prefs_cache_lock:
+            _prefs_cache[key] = entry
+    return entry
 
 def update_user_preferences(user_id: str, app_id: str, update_data: dict):
-    ref = db.collection(
-        f'artifacts/{app_id}/users/{user_id}/preferences'
-    ).document('story_prefs')
-    ref.set({**update_data, 'last_updated': firestore.SERVER_TIMESTAMP}, merge=True)
-
-# --- Agentic planning step ---
-def agent_plan(user_id: str, app_id: str, keywords: str) -> dict:
-    prefs = get_user_preferences(user_id, app_id)
-    planner_prompt = f"""
-    You are a creative story planning agent.
-    User preferences: {safe_json_dumps(prefs)}
-    Keywords: {keywords}
-
-    Based on these, plan the best story approach.
-    Return JSON with:
-    - tone: the tone to use ("humorous", "adventurous", "positive", "neutral", etc.)
-    - plot_outline: 2-4 sentences describing the story's main arc
-    - length_in_words: integer (between 100 and 200)
+    _write_user_preferences(user_id, app_id, update_data)
+    _merge_cached_preferences(user_id, app_id, update_data)
+
+def _merge_cached_preferences(user_id: str, app_id: str, update_data: dict):
+    # Keep a cached copy current instead of forcing a re-read
+    key = (app_id, user_id)
+    with _prefs_cache_lock:
+        if key in _prefs_cache:
+            prefs = {
+                **_prefs_cache[key][0],
+                **{k: v for k, v in update_data.items() if k in PREFS_FIELDS}
+            }
+            _prefs_cache[key] = (prefs, safe_json_dumps(prefs))
+
+def increment_feedback_count(user_id: str, app_id: str, feedback_type: str):
+    # Server-side increment: one write, no read of the current counts
+    _write_user_preferences(user_id, app_id, {
+        'feedback_counts': {feedback_type: firestore.Increment(1)}
+    })
+    # The new count is only known server-side, so drop the cached copy
+    with _prefs_cache_lock:
+        _prefs_cache.pop((app_id, user_id), None)
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    # Same double-checked build as get_db, so concurrent first calls share
+    # one client. Imported on first use so instances without a topic skip it.
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                from google.cloud import pubsub_v1
+                _publisher = pubsub_v1.PublisherClient()
+    return _publisher
+
+def enqueue_preferences_update(user_id: str, app_id: str, update_data: dict):
+    """Apply a memory update without making the response wait on Firestore.
+
+    With PREFS_UPDATE_TOPIC set the update is published for
+    apply_preferences_update to write; otherwise it runs on the background pool.
+    The publish is confirmed before returning, since the client only batches
+    messages and its sender thread may not run once the response is sent.
     """
+    if not PREFS_UPDATE_TOPIC:
+        run_in_background(update_user_preferences, user_id, app_id, update_data)
+        return
+
+    payload = {'userId': user_id, 'appId': app_id, 'update': update_data}
+    try:
+        get_publisher().publish(
+            PREFS_UPDATE_TOPIC, safe_json_dumps(payload).encode()
+        ).result(timeout=PREFS_PUBLISH_TIMEOUT)
+    except Exception as e:
+        # The story is already generated; never fail the response over memory
+        print(f"[Background] Publishing preferences update failed — {e}")
+        run_in_background(update_user_preferences, user_id, app_id, update_data)
+        return
+    _merge_cached_preferences(user_id, app_id, update_data)
+
+# --- Story cache ---
+# Recent cache entries (with unit-length embeddings) for similarity lookups,
+# loaded lazily from Firestore on the first miss of a fresh instance. Request
+# threads scan it while background writes append to it, so all access goes
+# through _embedding_index_lock.
+_embedding_index = None
+_embedding_index_lock = threading.Lock()
+
+def normalize_keywords(keywords: str) -> str:
+    return ' '.join(keywords.lower().split())
+
+def story_cache_key(app_id: str, keywords: str, tone: str) -> str:
+    raw = f"{app_id}|{normalize_keywords(keywords)}|{tone}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
 
-    planner_model = genai.GenerativeModel('gemini-1.5-pro')
-    plan_response = planner_model.generate_content(planner_prompt)
-    
+def _unit_vector(vector: list) -> list:
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else list(vector)
+
+def embed_keywords(keywords: str):
     try:
-        plan = json.loads(plan_response.text)
-    except json.JSONDecodeError:
-        # fallback if model returns plain text
-        plan = {
-            "tone": prefs.get("preferred_tone", "neutral"),
-            "plot_outline": f"Story based on: {keywords}",
-            "length_in_words": 150
-        }
-    return plan
-
-# --- Story execution step ---
-def generate_story_from_plan(plan: dict) -> str:
-    execution_prompt = f"""
-    Write a {plan['length_in_words']}-word story.
-    Tone: {plan['tone']}
-    Plot outline: {plan['plot_outline']}
-    Ensure it's engaging, coherent, and tailored to the tone.
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=normalize_keywords(keywords))
+    except Exception as e:
+        print(f"[Story Cache] Embedding failed — {e}")
+        return None
+    return _unit_vector(result['embedding'])
+
+def _get_embedding_index() -> deque:
+    # Callers must hold _embedding_index_lock, so concurrent first misses
+    # share a single load
+    global _embedding_index
+    if _embedding_index is None:
+        index = deque(maxlen=EMBEDDING_INDEX_SIZE)
+        try:
+            docs = get_db().collection(STORY_CACHE_COLLECTION).order_by(
+                'ts', direction=firestore.Query.DESCENDING
+            ).limit(EMBEDDING_INDEX_SIZE).stream()
+            for doc in docs:
+                entry = doc.to_dict()
+                if entry.get('embedding'):
+                    index.appendleft(entry)
+        except Exception as e:
+            print(f"[Story Cache] Could not load embedding index — {e}")
+        _embedding_index = index
+    return _embedding_index
+
+def _is_expired(entry: dict) -> bool:
+    # TTL deletion can lag expiry by up to a day, so check it on read too
+    expire_at = entry.get('expire_at')
+    return expire_at is not None and expire_at <= datetime.now(timezone.utc)
+
+def get_cached_story(cache_key: str):
+    doc = get_db().collection(STORY_CACHE_COLLECTION).document(cache_key).get()
+    if not doc.exists:
+        return None
+    entry = doc.to_dict()
+    return None if _is_expired(entry) else entry
+
+def find_similar_story(embedding: list, app_id: str, tone: str):
+    with _embedding_index_lock:
+        entries = list(_get_embedding_index())
+    best, best_score = None, SIMILARITY_THRESHOLD
+    for entry in entries:
+        if entry.get('app_id') != app_id or entry.get('tone') != tone or _is_expired(entry):
+            continue
+        score = sum(a * b for a, b in zip(embedding, entry['embedding']))
+        if score >= best_score:
+            best, best_score = entry, score
+    return best
+
+def store_cached_story(cache_key: str, app_id: str, keywords: str, tone: str, embedding, plan: dict, story: str):
+    entry = {
+        'app_id': app_id,
+        'normalized_keywords': normalize_keywords(keywords),
+        'tone': tone,
+        'embedding': embedding,
+        'plan': plan,
+        'story': story,
+        'expire_at': datetime.now(timezone.utc) + STORY_CACHE_TTL,
+    }
+    get_db().collection(STORY_CACHE_COLLECTION).document(cache_key).set(
+        {**entry, 'ts': firestore.SERVER_TIMESTAMP}
+    )
+    if embedding is not None:
+        with _embedding_index_lock:
+            _get_embedding_index().append(entry)
+
+# --- Agentic planning + story generation (single call) ---
+class Plan(TypedDict):
+    tone: str
+    plot_outline: str
+    length_in_words: int
+
+class StorySchema(Plan):
+    story: str
+
+# Static instructions live in the system instruction so the shared prefix is
+# identical across calls; only preferences and keywords vary per request.
+STORY_SYSTEM_INSTRUCTION = """
+You are a creative story planning agent and writer.
+You will be given the user's preferences and a set of keywords.
+Based on these, plan the best story approach and then write the story.
+Return JSON with:
+- tone: the tone to use ("humorous", "adventurous", "positive", "neutral", etc.)
+- plot_outline: 2-4 sentences describing the story's main arc
+- length_in_words: integer (between 100 and 200)
+- story: the story itself, about length_in_words words long, following the
+  plot outline in the chosen tone. Ensure it's engaging and coherent.
+"""
+
+# Per-request part of the prompt; prefs arrive pre-encoded from the prefs cache
+USER_PROMPT_TEMPLATE = "User preferences: {prefs}\nKeywords: {keywords}"
+
+# Built once per instance so warm invocations reuse the client state
+STORY_MODEL = genai.GenerativeModel(
+    'gemini-1.5-flash',
+    system_instruction=STORY_SYSTEM_INSTRUCTION,
+    generation_config={
+        "response_mime_type": "application/json",
+        "response_schema": StorySchema,
+    },
+)
+
+def build_user_prompt(prefs_json: str, keywords: str) -> str:
+    return USER_PROMPT_TEMPLATE.format_map({'prefs': prefs_json, 'keywords': keywords})
+
+def generate_plan_and_story(prefs_json: str, keywords: str) -> dict:
+    prompt = build_user_prompt(prefs_json, keywords)
+    # The response schema constrains output to valid JSON; failures raise and
+    # are handled by the request's error path.
+    response = STORY_MODEL.generate_content(prompt)
+    return json.loads(response.text)
+
+# --- Planner + writer generation (streaming responses) ---
+PLANNER_SYSTEM_INSTRUCTION = """
+You are a creative story planning agent.
+You will be given the user's preferences and a set of keywords.
+Based on these, plan the best story approach.
+Return JSON with:
+- tone: the tone to use ("humorous", "adventurous", "positive", "neutral", etc.)
+- plot_outline: 2-4 sentences describing the story's main arc
+- length_in_words: integer (between 100 and 200)
+"""
+
+WRITER_SYSTEM_INSTRUCTION = """
+You are a creative story writer.
+You will be given a target length, a tone and a plot outline.
+Write the story. Ensure it's engaging, coherent, and tailored to the tone.
+"""
+
+PLANNER_MODEL = genai.GenerativeModel(
+    'gemini-1.5-flash',
+    system_instruction=PLANNER_SYSTEM_INSTRUCTION,
+    generation_config={
+        "response_mime_type": "application/json",
+        "response_schema": Plan,
+    },
+)
+
+WRITER_MODEL = genai.GenerativeModel(
+    'gemini-1.5-flash',
+    system_instruction=WRITER_SYSTEM_INSTRUCTION,
+)
+
+def plan_story(prefs_json: str, keywords: str) -> dict:
+    prompt = build_user_prompt(prefs_json, keywords)
+    response = PLANNER_MODEL.generate_content(prompt)
+    return json.loads(response.text)
+
+def default_plan_for(keywords: str) -> dict:
+    return {
+        "tone": "neutral",
+        "plot_outline": f"A short story about {keywords}",
+        "length_in_words": 150
+    }
+
+def _writer_prompt(plan: dict) -> str:
+    return (
+        f"Length in words: {plan['length_in_words']}\n"
+        f"Tone: {plan['tone']}\n"
+        f"Plot outline: {plan['plot_outline']}"
+    )
+
+def stream_story_from_plan(plan: dict):
+    for chunk in WRITER_MODEL.generate_content(_writer_prompt(plan), stream=True):
+        yield chunk.text
+
+def stream_story_lines(plan: dict, chunks, on_complete):
+    """Yield NDJSON lines: the plan first, then each story chunk.
+
+    on_complete is called with the full story once every chunk has been sent.
     """
+    yield safe_json_dumps({'plan': plan}) + "\n"
+    parts = []
+    try:
+        for text in chunks:
+            parts.append(text)
+            yield safe_json_dumps({'chunk': text}) + "\n"
+    except Exception as e:
+        # Headers are already sent, so report the failure in-band
+        print(f"Error: {e}")
+        yield safe_json_dumps({'error': str(e)}) + "\n"
+        return
+    on_complete(''.join(parts))
+
+# --- Request schema ---
+# Firestore document ids cannot contain '/', be '.' or '..', match __.*__, or
+# exceed 1500 bytes. Missing or empty ids decode as '' and are reported by the
+# handler, which also applies the byte limit to multi-byte ids.
+MAX_DOCUMENT_ID_BYTES = 1500
+DocumentId = Annotated[str, msgspec.Meta(
+    max_length=MAX_DOCUMENT_ID_BYTES, pattern=r'^(?!\.\.?$)(?!__.*__$)[^/]*$'
+)]
+
+class StoryRequest(msgspec.Struct):
+    userId: DocumentId = ''
+    appId: DocumentId = ''
+    keywords: str = ''
+    feedbackType: Optional[str] = None
+    stream: bool = False
 
-    executor_model = genai.GenerativeModel('gemini-1.5-flash')
-    result = executor_model.generate_content(execution_prompt)
-    return result.text
+def request_error_message(error: msgspec.ValidationError) -> str:
+    # Id failures would otherwise echo the internal pattern back to clients
+    message = str(error)
+    for field in ('userId', 'appId'):
+        if message.endswith(f"`$.{field}`"):
+            return f"Invalid {field}"
+    return message
 
 # --- Cloud Function ---
 @functions_framework.http
 def generate_story_function(request):
     request_origin = request.headers.get('Origin')
-    headers = {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, X-Requested-With, Authorization',
-        'Access-Control-Max-Age': '3600'
-    }
-
-    if request_origin and (request_origin in ALLOWED_ORIGINS or '*' in ALLOWED_ORIGINS):
-        headers['Access-Control-Allow-Origin'] = request_origin
+    if request_origin and (ALLOW_ANY_ORIGIN or request_origin in ALLOWED_ORIGINS):
+        headers = {**BASE_HEADERS, 'Access-Control-Allow-Origin': request_origin}
+    else:
+        headers = dict(BASE_HEADERS)
 
     if request.method == 'OPTIONS':
         return ('', 204, headers)
 
-    request_json = request.get_json(silent=True)
-    if not request_json:
+    # Reject malformed payloads before any Firestore or Gemini work
+    try:
+        payload = msgspec.json.decode(request.get_data(), type=StoryRequest)
+    except msgspec.ValidationError as e:
+        return (safe_json_dumps({'error': request_error_message(e)}), 400, headers)
+    except msgspec.DecodeError:
         return (safe_json_dumps({'error': 'Invalid JSON or missing request body'}), 400, headers)
 
-    keywords = request_json.get('keywords', '').strip()
-    user_id = request_json.get('userId')
-    app_id = request_json.get('appId')
-    feedback_type = request_json.get('feedbackType')
+    keywords = payload.keywords.strip()
+    user_id = payload.userId
+    app_id = payload.appId
+    feedback_type = payload.feedbackType
+    stream = payload.stream
 
     if not user_id:
         return (safe_json_dumps({'error': 'Missing userId'}), 400, headers)
     if not app_id:
         return (safe_json_dumps({'error': 'Missing appId'}), 400, headers)
+    if len(user_id.encode()) > MAX_DOCUMENT_ID_BYTES:
+        return (safe_json_dumps({'error': 'Invalid userId'}), 400, headers)
+    if len(app_id.encode()) > MAX_DOCUMENT_ID_BYTES:
+        return (safe_json_dumps({'error': 'Invalid appId'}), 400, headers)
 
     try:
         # Handle feedback updates only
         if feedback_type:
-            prefs = get_user_preferences(user_id, app_id)
-            feedback_counts = prefs.get('feedback_counts', {})
-            feedback_counts[feedback_type] = feedback_counts.get(feedback_type, 0) + 1
-            update_user_preferences(user_id, app_id, {"feedback_counts": feedback_counts})
+            increment_feedback_count(user_id, app_id, feedback_type)
             return (safe_json_dumps({'message': f'Feedback {feedback_type} processed.'}), 200, headers)
 
         if not keywords:
             return (safe_json_dumps({'error': 'Missing keywords for story generation'}), 400, headers)
 
-        # Phase 1: Plan
-        plan = agent_plan(user_id, app_id, keywords)
+        # Embed the keywords while the user's preferences are read
+        embedding_future = _request_executor.submit(embed_keywords, keywords)
+        prefs, prefs_json = get_user_preferences(user_id, app_id)
+        tone = prefs.get("preferred_tone", "neutral")
+
+        # Serve repeat and near-duplicate requests from the story cache
+        cache_key = story_cache_key(app_id, keywords, tone)
+        embedding = None
+        cached = get_cached_story(cache_key)
+        if cached is not None:
+            # Exact hit: the embedding is not needed; skip it if not yet started
+            embedding_future.cancel()
+        else:
+            embedding = embedding_future.result()
+            if embedding is not None:
+                cached = find_similar_story(embedding, app_id, tone)
 
-        # Phase 2: Generate story
-        story = generate_story_from_plan(plan)
+        def remember(story: str):
+            if cached is None:
+                run_in_background(store_cached_story, cache_key, app_id, keywords, tone, embedding, plan, story)
+            # Memory update (store tone, last plan, last keywords) off the response path
+            enqueue_preferences_update(user_id, app_id, {
+                "preferred_tone": plan.get("tone", "neutral"),
+                "last_keywords": keywords,
+                "last_plan": plan
+            })
 
-        # Phase 3: Memory update (store tone, last plan, last keywords)
-        update_user_preferences(user_id, app_id, {
-            "preferred_tone": plan.get("tone", "neutral"),
-            "last_keywords": keywords,
-            "last_plan": plan
-        })
+        if stream:
+            # Short keywords from a user with no history gain nothing from a
+            # separate planner round-trip before streaming starts
+            simple = cached is None and not prefs and len(keywords.split()) <= SIMPLE_KEYWORD_LIMIT
+
+            # Send the plan as soon as it exists, then story text as it arrives
+            if cached is not None:
+                plan, chunks = cached['plan'], [cached['story']]
+            elif simple:
+                plan = default_plan_for(keywords)
+                chunks = stream_story_from_plan(plan)
+            else:
+                plan = plan_story(prefs_json, keywords)
+                chunks = stream_story_from_plan(plan)
+            return Response(
+                stream_story_lines(plan, chunks, remember),
+                mimetype='application/x-ndjson',
+                headers=headers,
+            )
+
+        if cached is not None:
+            plan, story = cached['plan'], cached['story']
+        else:
+            # Plan and write the story in one structured round-trip
+            result = generate_plan_and_story(prefs_json, keywords)
+            story = result.pop("story")
+            plan = result
+
+        remember(story)
 
         return (safe_json_dumps({'plan': plan, 'story': story}), 200, headers)
 
     except Exception as e:
         print(f"Error: {e}")
         return (safe_json_dumps({'error': str(e)}), 500, headers)
+
+@functions_framework.cloud_event
+def apply_preferences_update(cloud_event):
+    """Pub/Sub consumer that writes updates queued by enqueue_preferences_update."""
+    payload = json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
+    update_user_preferences(payload['userId'], payload['appId'], payload['update'])
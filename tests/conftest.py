@@ -0,0 +1,6 @@
+import os
+import sys
+
+# main.py lives at the repository root and refuses to import without a key
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
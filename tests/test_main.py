@@ -0,0 +1,106 @@
+import json
+from types import SimpleNamespace
+
+import main
+
+
+class FakeModel:
+    def __init__(self, text):
+        self.text = text
+        self.prompts = []
+
+    def generate_content(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return SimpleNamespace(text=self.text)
+
+
+def test_module_imports():
+    assert callable(main.generate_story_function)
+    assert callable(main.apply_preferences_update)
+
+
+def test_generate_plan_and_story_parses_structured_output(monkeypatch):
+    result = {
+        "tone": "humorous",
+        "plot_outline": "A cat learns to fly.",
+        "length_in_words": 120,
+        "story": "Once upon a time...",
+    }
+    model = FakeModel(json.dumps(result))
+    monkeypatch.setattr(main, "STORY_MODEL", model)
+
+    assert main.generate_plan_and_story('{"preferred_tone":"humorous"}', "cat, flying") == result
+    assert model.prompts == ['User preferences: {"preferred_tone":"humorous"}\nKeywords: cat, flying']
+
+
+def test_story_model_is_built_at_import_with_schema():
+    config = main.STORY_MODEL._generation_config
+    assert config["response_mime_type"] == "application/json"
+    assert set(config["response_schema"].properties) == {
+        "tone", "plot_outline", "length_in_words", "story"
+    }
+
+
+def test_planner_model_uses_plan_schema():
+    config = main.PLANNER_MODEL._generation_config
+    assert set(config["response_schema"].properties) == set(main.Plan.__annotations__)
+
+
+def test_failed_publish_falls_back_to_background_write(monkeypatch):
+    class FailingPublisher:
+        def publish(self, topic, data):
+            raise RuntimeError("no credentials")
+
+    writes = []
+    monkeypatch.setattr(main, "PREFS_UPDATE_TOPIC", "projects/p/topics/t")
+    monkeypatch.setattr(main, "get_publisher", FailingPublisher)
+    monkeypatch.setattr(main, "run_in_background", lambda fn, *args: writes.append((fn, args)))
+
+    main.enqueue_preferences_update("u", "a", {"last_keywords": "cat"})
+
+    assert writes == [(main.update_user_preferences, ("u", "a", {"last_keywords": "cat"}))]
+
+
+class FakeRequest:
+    method = "POST"
+    headers = {}
+
+    def __init__(self, body):
+        self.body = body
+
+    def get_data(self):
+        return self.body
+
+
+def error_for(body):
+    response, status, _ = main.generate_story_function(FakeRequest(body))
+    assert status == 400
+    return json.loads(response)["error"]
+
+
+def test_request_validation_messages():
+    assert error_for(b"") == "Invalid JSON or missing request body"
+    assert error_for(b'{"appId": "a"}') == "Missing userId"
+    assert error_for(b'{"userId": "u"}') == "Missing appId"
+    assert error_for(b'{"userId": "..", "appId": "a"}') == "Invalid userId"
+    assert error_for(b'{"userId": "u", "appId": "__a__"}') == "Invalid appId"
+    assert error_for(b'{"userId": "u/v", "appId": "a"}') == "Invalid userId"
+    assert error_for(('{"userId": "%s", "appId": "a"}' % ("é" * 800)).encode()) == "Invalid userId"
+    assert error_for(('{"userId": "u", "appId": "%s"}' % ("a" * 1501)).encode()) == "Invalid appId"
+
+
+def test_find_similar_story_skips_other_apps_and_expired_entries(monkeypatch):
+    from collections import deque
+    from datetime import datetime, timedelta, timezone
+
+    now = datetime.now(timezone.utc)
+    entry = {"app_id": "a", "tone": "neutral", "embedding": [1.0, 0.0]}
+    index = deque([
+        {**entry, "app_id": "other", "story": "other app"},
+        {**entry, "expire_at": now - timedelta(seconds=1), "story": "expired"},
+        {**entry, "expire_at": now + timedelta(days=1), "story": "fresh"},
+    ])
+    monkeypatch.setattr(main, "_embedding_index", index)
+
+    assert main.find_similar_story([1.0, 0.0], "a", "neutral")["story"] == "fresh"
+    assert main.find_similar_story([1.0, 0.0], "b", "neutral") is None